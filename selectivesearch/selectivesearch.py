@@ -2,13 +2,19 @@
 from __future__ import division
 
 import skimage.io
-import skimage.feature
 import skimage.color
 import skimage.transform
 import skimage.util
 import skimage.segmentation
+import scipy.ndimage
 import numpy
 import math
+import collections
+import heapq
+import itertools
+import multiprocessing.pool
+import os
+import warnings
 
 
 # "Selective Search for Object Recognition" by J.R.R. Uijlings et al.
@@ -27,56 +33,186 @@ def _generate_segments(im_orig, scale, sigma, min_size):
         skimage.util.img_as_float(im_orig), scale=scale, sigma=sigma,
         min_size=min_size)
     
-    # merge mask channel to the image as a 4th channel
-    im_orig = numpy.append(
-        im_orig, numpy.zeros(im_orig.shape[:2])[:, :, numpy.newaxis], axis=2)
-    im_orig[:, :, 3] = im_mask
+    # merge mask channel to the image as a 4th channel, at least float64 so
+    # the labels fit next to e.g. uint8 pixels
+    img = numpy.empty(
+        im_orig.shape[:2] + (4,),
+        dtype=numpy.result_type(im_orig.dtype, numpy.float64))
+    img[:, :, :3] = im_orig
+    img[:, :, 3] = im_mask
+
+    return img
+
+
+# regions are held as parallel arrays, row k of every field describes
+# region k and rows of merged regions are appended after the initial ones.
+# label holds the label of each initial region, a merged region keeps the
+# two regions it was made of in children and the count of its labels in
+# labels_len
+_Regions = collections.namedtuple('_Regions', [
+    'min_x', 'min_y', 'max_x', 'max_y',
+    'og_min_x', 'og_min_y', 'og_max_x', 'og_max_y',
+    'size', 'bbox_size', 'hist_c', 'hist_t',
+    'label', 'children', 'labels_len'])
+
+
+def _alloc_regions(labels, hist_c_len, hist_t_len):
+    """
+        allocate arrays for the initial regions of `labels` and every
+        region merged from them, at most 2 * len(labels) - 1
+    """
+    capacity = 2 * len(labels)
+
+    def coords():
+        return numpy.zeros(capacity, dtype=numpy.int32)
+
+    return _Regions(
+        min_x=coords(), min_y=coords(), max_x=coords(), max_y=coords(),
+        og_min_x=coords(), og_min_y=coords(),
+        og_max_x=coords(), og_max_y=coords(),
+        size=coords(), bbox_size=coords(),
+        hist_c=numpy.zeros((capacity, hist_c_len), dtype=numpy.float32),
+        hist_t=numpy.zeros((capacity, hist_t_len), dtype=numpy.float32),
+        label=numpy.asarray(labels),
+        children=numpy.full((capacity, 2), -1, dtype=numpy.int32),
+        labels_len=numpy.ones(capacity, dtype=numpy.int32))
+
+
+def _flatten_labels(R, n_regions):
+    """
+        labels of every region in CSR form, region k holds
+        labels_buf[labels_start[k]:labels_start[k] + R.labels_len[k]]
+
+        the labels of a merged region are those of its first child followed
+        by those of the second, so laying the initial regions out in the
+        order of the merge tree makes every region a contiguous run
+    """
+    labels_start = numpy.zeros(n_regions, dtype=numpy.int32)
+    labels_buf = numpy.empty(len(R.label), dtype=R.label.dtype)
+
+    children = R.children[:n_regions]
+    is_child = numpy.zeros(n_regions, dtype=bool)
+    is_child[children[children >= 0]] = True
+
+    # a merged region comes after its children, walking backwards places
+    # every region before the regions it was made of
+    cursor = 0
+    for k in range(n_regions - 1, -1, -1):
+        if not is_child[k]:
+            labels_start[k] = cursor
+            cursor += R.labels_len[k]
+        i, j = children[k]
+        if i < 0:
+            labels_buf[labels_start[k]] = R.label[k]
+        else:
+            labels_start[i] = labels_start[k]
+            labels_start[j] = labels_start[k] + R.labels_len[i]
 
-    return im_orig
+    return labels_start, labels_buf
 
 
-def _sim_colour(r1, r2):
+def _sim_colour(R, i, j):
     """
         calculate the sum of histogram intersection of colour
     """
-    return sum([min(a, b) for a, b in zip(r1["hist_c"], r2["hist_c"])])
+    return numpy.minimum(R.hist_c[i], R.hist_c[j]).sum(axis=-1)
 
 
-def _sim_texture(r1, r2):
+def _sim_texture(R, i, j):
     """
         calculate the sum of histogram intersection of texture
     """
-    return sum([min(a, b) for a, b in zip(r1["hist_t"], r2["hist_t"])])
+    return numpy.minimum(R.hist_t[i], R.hist_t[j]).sum(axis=-1)
 
 
-def _sim_size(r1, r2, imsize):
+def _sim_size(R, i, j, inv_imsize):
     """
         calculate the size similarity over the image
     """
-    return 1.0 - (r1["size"] + r2["size"]) / imsize
+    return 1.0 - (R.size[i] + R.size[j]) * inv_imsize
 
 
-def _sim_fill(r1, r2, imsize):
+def _sim_fill(R, i, j, inv_imsize):
     """
         calculate the fill similarity over the image
     """
     bbsize = (
-        (max(r1["max_x"], r2["max_x"]) - min(r1["min_x"], r2["min_x"]))
-        * (max(r1["max_y"], r2["max_y"]) - min(r1["min_y"], r2["min_y"]))
+        (numpy.maximum(R.max_x[i], R.max_x[j])
+         - numpy.minimum(R.min_x[i], R.min_x[j]))
+        * (numpy.maximum(R.max_y[i], R.max_y[j])
+           - numpy.minimum(R.min_y[i], R.min_y[j]))
     )
-    return 1.0 - (bbsize - r1["size"] - r2["size"]) / imsize
+    return 1.0 - (bbsize - R.size[i] - R.size[j]) * inv_imsize
+
+
+def _calc_sim(R, i, j, inv_imsize):
+    """
+        similarity of regions i and j, either may be an array of regions
+        to compare many pairs at once
+
+        inv_imsize is 1 / (number of pixels in the image)
+    """
+    return (_sim_colour(R, i, j) + _sim_texture(R, i, j)
+            + _sim_size(R, i, j, inv_imsize)
+            + _sim_fill(R, i, j, inv_imsize))
+
+
+def _histogram_bins(values, bins, value_range):
+    """
+        bin index of each value as numpy.histogram would assign it
+
+        values out of the range are marked with -1
+    """
+    lo, hi = value_range
+    edges = numpy.linspace(lo, hi, bins + 1)
+    outside = (values < lo) | (values > hi)
+
+    idx = numpy.floor((values - lo) * (bins / (hi - lo))).astype(numpy.intp)
+    idx = numpy.clip(idx, 0, bins - 1)
+
+    # correct the rounding of the scaled values against the real edges
+    idx -= values < edges[idx]
+    idx += (values >= edges[idx + 1]) & (idx != bins - 1)
+    idx[outside] = -1
+
+    return idx
 
 
-def _calc_sim(r1, r2, imsize):
-    return (_sim_colour(r1, r2) + _sim_texture(r1, r2)
-            + _sim_size(r1, r2, imsize) + _sim_fill(r1, r2, imsize))
+def _calc_region_hist(img, labels, sizes, bins, value_range):
+    """
+        L1 normalized histogram of each channel for every region, in
+        float32 as the bins only hold a fraction of the region size
+
+        sizes is the number of pixels of each region, every pixel is
+        given its slot in the flattened [n_regions][channels][bins] output
+        and counted by one bincount
+
+        output will be [n_regions][bins * channels]
+    """
+    n_regions, channels = len(sizes), img.shape[1]
+    idx = _histogram_bins(img, bins, value_range)
+    valid = idx >= 0
+
+    slot = (labels[:, None] * channels + numpy.arange(channels)) * bins + idx
+    hist = numpy.bincount(slot[valid], minlength=n_regions * channels * bins)
+    hist = hist.astype(numpy.float32).reshape(n_regions, channels * bins)
+
+    # L1 normalize
+    hist /= numpy.maximum(sizes, 1).astype(numpy.float32)[:, None]
+
+    return hist
 
 
-def _calc_colour_hist(img):
+def _calc_colour_hist(img, labels, sizes):
     """
         calculate colour histogram for each region
 
-        the size of output histogram will be BINS * COLOUR_CHANNELS(3)
+        img is the [pixels][channels] array of the entire image, labels
+        the region of each pixel and sizes the number of pixels of each
+        region, all regions are filled in a single pass
+
+        the size of output histogram will be
+            [n_regions][BINS * COLOUR_CHANNELS(3)]
 
         number of bins is 25 as same as [uijlings_ijcv2013_draft.pdf]
 
@@ -84,24 +220,217 @@ def _calc_colour_hist(img):
     """
 
     BINS = 25
-    hist = numpy.array([])
 
-    for colour_channel in (0, 1, 2):
+    return _calc_region_hist(img[:, :3], labels, sizes, BINS, (0.0, 255.0))
 
-        # extracting one colour channel
-        c = img[:, colour_channel]
 
-        # calculate histogram for each colour and join to the result
-        hist = numpy.concatenate(
-            [hist] + [numpy.histogram(c, BINS, (0.0, 255.0))[0]])
+def _usable_cpus():
+    """
+        number of CPUs this process may run on, which respects affinity
+        and cgroup cpusets unlike the count of CPUs on the host
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:  # not available on every platform
+        return os.cpu_count() or 1
 
-    # L1 normalize
-    hist = hist / len(img)
 
-    return hist
+def _local_binary_pattern(img, use_gpu=False):
+    """
+        LBP of 8 points on a circle of radius 1 for every channel at once
+
+        gives the same codes as skimage.feature.local_binary_pattern(c, 8, 1.0)
+        on each channel c: the diagonal points are bilinearly interpolated
+        and points outside of the image are 0
+
+        with use_gpu large images are computed on the GPU if numba and a
+        CUDA device are available, otherwise on the CPU
+
+        output will be [height(*)][width(*)][channels(*)]
+    """
+    # rows per thread below which splitting the image does not pay off
+    MIN_ROWS = 64
+
+    channels, height, width = img.shape[2], img.shape[0], img.shape[1]
+    img = numpy.ascontiguousarray(
+        numpy.moveaxis(img, 2, 0), dtype=numpy.float64)
+    padded = numpy.pad(img, ((0, 0), (1, 1), (1, 1)), mode='constant')
+
+    angles = 2 * numpy.pi * numpy.arange(8) / 8
+    rp = numpy.round(-numpy.sin(angles), 5)
+    cp = numpy.round(numpy.cos(angles), 5)
+
+    if use_gpu and height * width >= _CUDA_MIN_PIXELS:
+        code = _local_binary_pattern_cuda(padded, rp, cp)
+        if code is not None:
+            return numpy.moveaxis(code, 0, 2)
+
+    code = numpy.zeros((channels, height, width), dtype=numpy.uint8)
+
+    def lbp_rows(rows):
+        y0, y1 = rows
+        centre = img[:, y0:y1]
+        out = code[:, y0:y1]
+        bit = numpy.empty(centre.shape, dtype=bool)
+
+        def shifted(dy, dx):
+            return padded[:, 1 + y0 + dy:1 + y1 + dy, 1 + dx:1 + dx + width]
+
+        for p in range(8):
+            min_r, max_r = int(numpy.floor(rp[p])), int(numpy.ceil(rp[p]))
+            min_c, max_c = int(numpy.floor(cp[p])), int(numpy.ceil(cp[p]))
+
+            if min_r == max_r and min_c == max_c:
+                texture = shifted(min_r, min_c)
+            else:
+                r = numpy.arange(y0, y1, dtype=numpy.float64) + rp[p]
+                c = numpy.arange(width, dtype=numpy.float64) + cp[p]
+                dr = (r - numpy.floor(r))[:, None]
+                dc = (c - numpy.floor(c))[None, :]
+
+                top = (
+                    (1 - dc) * shifted(min_r, min_c)
+                    + dc * shifted(min_r, max_c))
+                bottom = (
+                    (1 - dc) * shifted(max_r, min_c)
+                    + dc * shifted(max_r, max_c))
+                texture = (1 - dr) * top + dr * bottom
+
+            # set bit p where the point is not darker than the centre
+            numpy.greater_equal(texture - centre, 0, out=bit)
+            out |= bit.view(numpy.uint8) << p
+
+    # numpy releases the GIL, so bands of rows are computed in parallel
+    n_bands = max(1, min(_usable_cpus(), height // MIN_ROWS))
+    bounds = numpy.linspace(0, height, n_bands + 1).astype(int)
+    bands = list(zip(bounds[:-1], bounds[1:]))
+
+    if n_bands == 1:
+        lbp_rows(bands[0])
+    else:
+        pool = multiprocessing.pool.ThreadPool(n_bands)
+        try:
+            pool.map(lbp_rows, bands)
+        finally:
+            pool.close()
+
+    return numpy.moveaxis(code, 0, 2)
+
+
+# smaller images are not worth the transfer to and from the GPU
+_CUDA_MIN_PIXELS = 1024 * 1024
+
+# threads per side of a CUDA block and the side of its tile with the halo
+_CUDA_BLOCK = 16
+_CUDA_TILE = _CUDA_BLOCK + 2
+
+# compiled CUDA kernel, built on first use
+_lbp_kernel = None
+
+
+def _get_lbp_kernel():
+    """
+        import numba only when the GPU path is used and compile the LBP
+        kernel once
+    """
+    global _lbp_kernel
+
+    if _lbp_kernel is not None:
+        return _lbp_kernel
 
+    import numba
+    from numba import cuda
 
-def _calc_texture_gradient(img):
+    @cuda.jit
+    def kernel(padded, offsets, dr, dc, code):
+        """
+            LBP code of one pixel of one channel per thread, every block
+            first loads its tile of the padded image into shared memory
+        """
+        tile = cuda.shared.array((_CUDA_TILE, _CUDA_TILE), numba.float64)
+
+        ch = cuda.blockIdx.z
+        tx, ty = cuda.threadIdx.x, cuda.threadIdx.y
+        x0 = cuda.blockIdx.x * _CUDA_BLOCK
+        y0 = cuda.blockIdx.y * _CUDA_BLOCK
+
+        for yy in range(ty, _CUDA_TILE, _CUDA_BLOCK):
+            for xx in range(tx, _CUDA_TILE, _CUDA_BLOCK):
+                if y0 + yy < padded.shape[1] and x0 + xx < padded.shape[2]:
+                    tile[yy, xx] = padded[ch, y0 + yy, x0 + xx]
+        cuda.syncthreads()
+
+        y, x = y0 + ty, x0 + tx
+        if y >= code.shape[1] or x >= code.shape[2]:
+            return
+
+        centre = tile[ty + 1, tx + 1]
+        value = 0
+        for p in range(8):
+            min_r, max_r = ty + 1 + offsets[p, 0], ty + 1 + offsets[p, 1]
+            min_c, max_c = tx + 1 + offsets[p, 2], tx + 1 + offsets[p, 3]
+
+            wc, wr = dc[p, x], dr[p, y]
+
+            top = (1 - wc) * tile[min_r, min_c] + wc * tile[min_r, max_c]
+            bottom = (1 - wc) * tile[max_r, min_c] + wc * tile[max_r, max_c]
+            texture = (1 - wr) * top + wr * bottom
+
+            if texture - centre >= 0:
+                value |= 1 << p
+        code[ch, y, x] = value
+
+    _lbp_kernel = kernel
+    return _lbp_kernel
+
+
+def _local_binary_pattern_cuda(padded, rp, cp):
+    """
+        _local_binary_pattern on the GPU, padded is the zero padded
+        [channels][height + 2][width + 2] image and rp, cp the offsets of
+        the 8 points
+
+        the interpolation weights are computed here exactly as on the CPU,
+        but the GPU may fuse their multiply-adds, so a diagonal point equal
+        to the centre can give a different bit than the CPU path
+
+        output will be [channels(*)][height(*)][width(*)], or None when
+        numba or a CUDA device is missing or the kernel fails
+    """
+    try:
+        from numba import cuda
+    except ImportError:
+        return None
+
+    if not cuda.is_available():
+        return None
+
+    channels = padded.shape[0]
+    height, width = padded.shape[1] - 2, padded.shape[2] - 2
+
+    offsets = numpy.stack([
+        numpy.floor(rp), numpy.ceil(rp), numpy.floor(cp), numpy.ceil(cp)],
+        axis=1).astype(numpy.int32)
+    r = numpy.arange(height, dtype=numpy.float64) + rp[:, None]
+    c = numpy.arange(width, dtype=numpy.float64) + cp[:, None]
+
+    grid = (
+        (width + _CUDA_BLOCK - 1) // _CUDA_BLOCK,
+        (height + _CUDA_BLOCK - 1) // _CUDA_BLOCK, channels)
+
+    try:
+        code = cuda.device_array((channels, height, width), dtype=numpy.uint8)
+        _get_lbp_kernel()[grid, (_CUDA_BLOCK, _CUDA_BLOCK, 1)](
+            cuda.to_device(padded), cuda.to_device(offsets),
+            cuda.to_device(r - numpy.floor(r)),
+            cuda.to_device(c - numpy.floor(c)), code)
+        return code.copy_to_host()
+    except Exception as e:
+        warnings.warn("LBP on the GPU failed, using the CPU: %s" % e)
+        return None
+
+
+def _calc_texture_gradient(img, use_gpu=False):
     """
         calculate texture gradient for entire image
 
@@ -111,169 +440,140 @@ def _calc_texture_gradient(img):
         output will be [height(*)][width(*)]
     """
     ret = numpy.zeros((img.shape[0], img.shape[1], img.shape[2]))
-
-    for colour_channel in (0, 1, 2):
-        ret[:, :, colour_channel] = skimage.feature.local_binary_pattern(
-            img[:, :, colour_channel], 8, 1.0)
+    ret[:, :, :3] = _local_binary_pattern(img[:, :, :3], use_gpu=use_gpu)
 
     return ret
 
 
-def _calc_texture_hist(img):
+def _calc_texture_hist(img, labels, sizes):
     """
         calculate texture histogram for each region
 
         calculate the histogram of gradient for each colours
         the size of output histogram will be
-            BINS * ORIENTATIONS * COLOUR_CHANNELS(3)
+            [n_regions][BINS * ORIENTATIONS * COLOUR_CHANNELS(3)]
     """
     BINS = 10
 
-    hist = numpy.array([])
+    return _calc_region_hist(img[:, :3], labels, sizes, BINS, (0.0, 1.0))
 
-    for colour_channel in (0, 1, 2):
 
-        # mask by the colour channel
-        fd = img[:, colour_channel]
+def _extract_regions(img, use_gpu=False):
 
-        # calculate histogram for each orientation and concatenate them all
-        # and join to the result
-        hist = numpy.concatenate(
-            [hist] + [numpy.histogram(fd, BINS, (0.0, 1.0))[0]])
+    # get hsv image
+    hsv = skimage.color.rgb2hsv(img[:, :, :3])
 
-    # L1 Normalize
-    hist = hist / len(img)
+    # pass 1: bounding box and size of each region
+    labels = img[:, :, 3].astype(numpy.int32)
+    labels_flat = labels.ravel()
+    slices = scipy.ndimage.find_objects(labels + 1)
+    sizes = numpy.bincount(labels_flat, minlength=len(slices))
+
+    # keep the regions in the order they first appear in the image, the
+    # first pixel of a region is on the top row of its bounding box
+    rows = numpy.flatnonzero(sizes)
+    first = numpy.array([
+        slices[l][0].start * labels.shape[1] + slices[l][1].start
+        + numpy.argmax(labels[slices[l][0].start, slices[l][1]] == l)
+        for l in rows], dtype=numpy.intp)
+    order = numpy.argsort(first, kind='stable')
+    rows, uniq = rows[order], img[:, :, 3].ravel()[first[order]]
 
-    return hist
+    # pass 2: calculate texture gradient
+    tex_grad = _calc_texture_gradient(img, use_gpu=use_gpu)
 
+    # pass 3: calculate colour and texture histograms of all regions
+    hist_c = _calc_colour_hist(
+        hsv.reshape(-1, hsv.shape[2]), labels_flat, sizes)
+    hist_t = _calc_texture_hist(
+        tex_grad.reshape(-1, tex_grad.shape[2]), labels_flat, sizes)
 
-def _extract_regions(img):
+    R = _alloc_regions(uniq, hist_c.shape[1], hist_t.shape[1])
+    n = len(uniq)
 
-    R = {}
+    for k, l in enumerate(rows):
+        sl_y, sl_x = slices[l]
+        R.min_x[k], R.max_x[k] = sl_x.start, sl_x.stop - 1
+        R.min_y[k], R.max_y[k] = sl_y.start, sl_y.stop - 1
 
-    # get hsv image
-    hsv = skimage.color.rgb2hsv(img[:, :, :3])
+    R.bbox_size[:n] = (R.max_x[:n] - R.min_x[:n]) * (R.max_y[:n] - R.min_y[:n])
+    R.size[:n] = sizes[rows]
+    R.hist_c[:n] = hist_c[rows]
+    R.hist_t[:n] = hist_t[rows]
 
-    # pass 1: count pixel positions
-    for y, i in enumerate(img):
-        for x, (r, g, b, l) in enumerate(i):
-            
-            # initialize a new region
-            if l not in R:
-                R[l] = {
-                    "min_x": 0xffff, "min_y": 0xffff,
-                    "max_x": 0, "max_y": 0, "labels": [l]}
-
-            # bounding box
-            if R[l]["min_x"] > x:
-                R[l]["min_x"] = x
-            if R[l]["min_y"] > y:
-                R[l]["min_y"] = y
-            if R[l]["max_x"] < x:
-                R[l]["max_x"] = x
-            if R[l]["max_y"] < y:
-                R[l]["max_y"] = y
-            
-            R[l]['bbox_size'] = (R[l]['max_x'] - R[l]['min_x']) * (R[l]['max_y'] - R[l]['min_y'])
+    return R
 
-    # pass 2: calculate texture gradient
-    tex_grad = _calc_texture_gradient(img)
 
-    # pass 3: calculate colour histogram of each region
-    for k, v in list(R.items()):
+def _extract_neighbours(img, R):
+    """
+        pairs of regions sharing a boundary in the label plane
 
-        # colour histogram
-        masked_pixels = hsv[:, :, :][img[:, :, 3] == k]
-        R[k]["size"] = len(masked_pixels / 4)
-        R[k]["hist_c"] = _calc_colour_hist(masked_pixels)
+        neighbours are found in one pass over the image by comparing every
+        pixel with the one below and the one to its right
+    """
+    n = len(R.label)
+    labels = img[:, :, 3].astype(numpy.int32)
 
-        # texture histogram
-        R[k]["hist_t"] = _calc_texture_hist(tex_grad[:, :][img[:, :, 3] == k])
+    # region of every pixel
+    row_of = numpy.zeros(labels.max() + 1, dtype=numpy.intp)
+    row_of[R.label.astype(numpy.int32)] = numpy.arange(n)
+    rows = row_of[labels]
 
-    return R
+    a = numpy.concatenate([rows[:-1, :].ravel(), rows[:, :-1].ravel()])
+    b = numpy.concatenate([rows[1:, :].ravel(), rows[:, 1:].ravel()])
+    edge = a != b
+    lo = numpy.minimum(a[edge], b[edge])
+    hi = numpy.maximum(a[edge], b[edge])
 
+    # unique pairs, ordered by the first and then the second region
+    key = numpy.unique(lo * n + hi)
+    pairs = numpy.stack([key // n, key % n], axis=1)
+
+    neighbours_mask = numpy.zeros(n)
+    neighbours_mask[pairs.ravel()] = True
+
+    return pairs, neighbours_mask
 
-    
-def _extract_neighbours(regions):
-
-    def intersect(a, b):
-        if (a["min_x"] < b["min_x"] < a["max_x"]
-                and a["min_y"] < b["min_y"] < a["max_y"]) or (
-            a["min_x"] < b["max_x"] < a["max_x"]
-                and a["min_y"] < b["max_y"] < a["max_y"]) or (
-            a["min_x"] < b["min_x"] < a["max_x"]
-                and a["min_y"] < b["max_y"] < a["max_y"]) or (
-            a["min_x"] < b["max_x"] < a["max_x"]
-                and a["min_y"] < b["min_y"] < a["max_y"]):
-            return True
-        return False
-
-    R = list(regions.items())
-    neighbours = []
-    neighbours_mask = numpy.zeros(len(R))
-
-    for cur, a in enumerate(R[:-1]):
-        for cur2, b in enumerate(R[cur + 1:]):
-            if intersect(a[1], b[1]):
-                neighbours.append((a, b))
-                neighbours_mask[cur] = True
-                neighbours_mask[cur + cur2 + 1] = True
-
-    # test
-    for i, there_is_neighbours in enumerate(neighbours_mask):
-        if not there_is_neighbours:
-            assert R[i] not in [b for (a, b) in neighbours]
-            
-
-    return neighbours, neighbours_mask
-
-
-def _merge_regions(r1, r2):
-    new_size = r1["size"] + r2["size"]
-    rt = {
-        "min_x": min(r1["min_x"], r2["min_x"]),
-        "min_y": min(r1["min_y"], r2["min_y"]),
-        "max_x": max(r1["max_x"], r2["max_x"]),
-        "max_y": max(r1["max_y"], r2["max_y"]),
-        'og_min_x': min(r1["og_min_x"], r2["og_min_x"]),
-        'og_min_y': min(r1["og_min_y"], r2["og_min_y"]),
-        'og_max_x': max(r1["og_max_x"], r2["og_max_x"]),
-        'og_max_y': max(r1["og_max_y"], r2["og_max_y"]),
-        "size": new_size,
-        "hist_c": (
-            r1["hist_c"] * r1["size"] + r2["hist_c"] * r2["size"]) / new_size,
-        "hist_t": (
-            r1["hist_t"] * r1["size"] + r2["hist_t"] * r2["size"]) / new_size,
-        "labels": r1["labels"] + r2["labels"]
-    }
-    rt['bbox_size'] = (rt['max_x'] - rt['min_x']) * (rt['max_y'] - rt['min_y'])
-    return rt
-
-def _expand_regions(regions, border, x_lim, y_lim):
-    R = regions.items()
-    R_new = {}
-    for i, r in enumerate(R):
-        r_new = {
-            'min_x': max(0, r[1]['min_x'] - border),
-            'min_y': max(0, r[1]['min_y'] - border),
-            'max_x': min(x_lim, r[1]['max_x'] + border),
-            'max_y': min(y_lim, r[1]['max_y'] + border),
-            'og_min_x': r[1]['min_x'], 
-            'og_min_y': r[1]['min_y'], 
-            'og_max_x': r[1]['max_x'], 
-            'og_max_y': r[1]['max_y'], 
-            'size': r[1]['size'],
-            'hist_c': r[1]['hist_c'],
-            'hist_t': r[1]['hist_t'],
-            'labels': r[1]['labels'],
-        }
-        r_new['bbox_size'] = (r[1]['max_x'] - r[1]['min_x']) * (r[1]['max_y'] - r[1]['min_y'])
-        R_new[i] = r_new
-    return R_new
+
+def _merge_regions(R, t, i, j):
+    """
+        merge regions i and j into the new region t
+    """
+    R.min_x[t] = min(R.min_x[i], R.min_x[j])
+    R.min_y[t] = min(R.min_y[i], R.min_y[j])
+    R.max_x[t] = max(R.max_x[i], R.max_x[j])
+    R.max_y[t] = max(R.max_y[i], R.max_y[j])
+    R.og_min_x[t] = min(R.og_min_x[i], R.og_min_x[j])
+    R.og_min_y[t] = min(R.og_min_y[i], R.og_min_y[j])
+    R.og_max_x[t] = max(R.og_max_x[i], R.og_max_x[j])
+    R.og_max_y[t] = max(R.og_max_y[i], R.og_max_y[j])
+    R.size[t] = R.size[i] + R.size[j]
+    R.hist_c[t] = (
+        R.hist_c[i] * R.size[i] + R.hist_c[j] * R.size[j]) / R.size[t]
+    R.hist_t[t] = (
+        R.hist_t[i] * R.size[i] + R.hist_t[j] * R.size[j]) / R.size[t]
+    R.bbox_size[t] = (R.max_x[t] - R.min_x[t]) * (R.max_y[t] - R.min_y[t])
+    R.children[t] = i, j
+    R.labels_len[t] = R.labels_len[i] + R.labels_len[j]
+
+
+def _expand_regions(R, border, x_lim, y_lim):
+    """
+        grow the bounding box of every region by `border` pixels, the
+        original bounding box is kept in the og_* fields
+    """
+    n = len(R.label)
+    R.og_min_x[:n], R.og_min_y[:n] = R.min_x[:n], R.min_y[:n]
+    R.og_max_x[:n], R.og_max_y[:n] = R.max_x[:n], R.max_y[:n]
+    R.min_x[:n] = numpy.maximum(0, R.min_x[:n] - border)
+    R.min_y[:n] = numpy.maximum(0, R.min_y[:n] - border)
+    R.max_x[:n] = numpy.minimum(x_lim, R.max_x[:n] + border)
+    R.max_y[:n] = numpy.minimum(y_lim, R.max_y[:n] + border)
 
 
 def selective_search(
-        im_orig, scale=1.0, sigma=0.8, min_size=50, region_pop=False, max_region_size=3000, border=10):
+        im_orig, scale=1.0, sigma=0.8, min_size=50, region_pop=False, max_region_size=3000, border=10,
+        use_gpu=False):
     '''Selective Search
 
     Parameters
@@ -286,6 +586,9 @@ def selective_search(
             Width of Gaussian kernel for felzenszwalb segmentation.
         min_size : int
             Minimum component size for felzenszwalb segmentation.
+        use_gpu : bool
+            Compute the LBP texture of images of 1 MP or more on a CUDA
+            device, needs numba. Falls back to the CPU when unavailable.
     Returns
     -------
         img : ndarray
@@ -310,93 +613,106 @@ def selective_search(
         return None, {}
 
     imsize = img.shape[0] * img.shape[1]
-    R = _extract_regions(img)
-    R = _expand_regions(R, border=border, x_lim=img.shape[1], y_lim=img.shape[0])
-    origin_size_of_R = len(R.keys())
+    inv_imsize = 1.0 / imsize
+    R = _extract_regions(img, use_gpu=use_gpu)
+    _expand_regions(R, border=border, x_lim=img.shape[1], y_lim=img.shape[0])
+    origin_size_of_R = len(R.label)
 
     # extract neighbouring information
-    neighbours, neighbours_mask = _extract_neighbours(R)
+    neighbours, neighbours_mask = _extract_neighbours(img, R)
 
     # R = _crop_no_neigublours_regions(no_neighbours_index, max_region_size)
 
 
     # calculate initial similarities
-    S = {}
-    for (ai, ar), (bi, br) in neighbours:
-        S[(ai, bi)] = _calc_sim(ar, br, imsize)
-
-
-
-    # test
-
-    first_region_to_pop = []
+    sims = _calc_sim(R, neighbours[:, 0], neighbours[:, 1], inv_imsize)
+    S = dict(zip(map(tuple, neighbours.tolist()), sims.tolist()))
+
+    # similarities each region takes part in, indexed by region like the
+    # arrays of R so that merged regions only fill their preallocated slot.
+    # every key maps to its rank in the insertion order of S, which decides
+    # between equal similarities and so has to be kept across merges
+    rank = itertools.count()
+    edges = [{} for _ in range(len(R.children))]
+    for k in S.keys():
+        edges[k[0]][k] = edges[k[1]][k] = next(rank)
+
+    first_region_to_pop = set()
     if region_pop:
-        key_to_delete = []
-        for t in R.keys():
-            if R[t]['bbox_size'] > max_region_size:
-                for k, v in list(S.items()):
-                    if t in k:
-                        if k not in key_to_delete:
-                            key_to_delete.append(k)
-                first_region_to_pop.append(t)
-        for k in key_to_delete:
-            del S[k]
+        too_large = R.bbox_size[:len(R.label)] > max_region_size
+        for t in numpy.flatnonzero(too_large).tolist():
+            for k in edges[t]:
+                del S[k]
+                del edges[k[1] if k[0] == t else k[0]][k]
+            edges[t] = {}
+            first_region_to_pop.add(t)
+
+    # max-heap of similarities, removed entries of S are skipped lazily.
+    # the negated rank breaks ties like the stable sort of S did before:
+    # among equal similarities the one inserted into S last wins
+    heap = [(-v, -edges[k[0]][k], k) for k, v in S.items()]
+    heapq.heapify(heap)
 
     # hierarchal search
+    n_regions = len(R.label)
     while S != {}:
         # check anny region is larger than prefered regional size
         # get highest similarity
-        i, j = sorted(S.items(), key=lambda i: i[1])[-1][0]
+        i, j = heapq.heappop(heap)[2]
+        if (i, j) not in S:
+            continue
 
         # merge corresponding regions
-        t = max(R.keys()) + 1.0
-        R[t] = _merge_regions(R[i], R[j])
+        t = n_regions
+        n_regions += 1
+        _merge_regions(R, t, i, j)
 
-        # mark similarities for regions to be removed
-        key_to_delete = []
-        for k, v in list(S.items()):
-            if (i in k) or (j in k):
-                key_to_delete.append(k)
+        # mark similarities for regions to be removed, in the order of S
+        key_to_delete = dict(edges[i])
+        key_to_delete.update(edges[j])
+        key_to_delete = sorted(key_to_delete, key=key_to_delete.get)
+        edges[i], edges[j] = {}, {}
 
         # remove old similarities of related regions
         for k in key_to_delete:
             del S[k]
+            for n in k:
+                if n not in (i, j):
+                    del edges[n][k]
 
         # calculate similarity set with the new region
-        if R[t]['bbox_size'] > max_region_size:
+        if R.bbox_size[t] > max_region_size:
             continue
         else:
-            for k in [a for a in key_to_delete if a != (i, j)]:
-                n = k[1] if k[0] in (i, j) else k[0]
-                S[(t, n)] = _calc_sim(R[t], R[n], imsize)
+            # only the neighbours of i and j need a similarity with t
+            nbrs = list(dict.fromkeys(
+                k[1] if k[0] in (i, j) else k[0]
+                for k in key_to_delete if k != (i, j)))
+            sims = _calc_sim(R, t, nbrs, inv_imsize).tolist()
+            for n, sim in zip(nbrs, sims):
+                S[(t, n)] = sim
+                r = next(rank)
+                heapq.heappush(heap, (-sim, -r, (t, n)))
+                edges[t][(t, n)] = edges[n][(t, n)] = r
 
     regions = []
 
-    for k, r in list(R.items()):
+    labels_start, labels_buf = _flatten_labels(R, n_regions)
+
+    for k in range(n_regions):
         # To Do: 
         if k not in first_region_to_pop:
+            min_x, min_y = int(R.min_x[k]), int(R.min_y[k])
+            max_x, max_y = int(R.max_x[k]), int(R.max_y[k])
             regions.append({
-                'rect': (
-                    r['min_x'], r['min_y'],
-                    r['max_x'] - r['min_x'], r['max_y'] - r['min_y']),
-                'bbox_size': r['bbox_size'],
-                'size': r['size'],
-                'labels': r['labels']
+                'rect': (min_x, min_y, max_x - min_x, max_y - min_y),
+                'bbox_size': int(R.bbox_size[k]),
+                'size': int(R.size[k]),
+                'labels': labels_buf[
+                    labels_start[k]:labels_start[k] + R.labels_len[k]].tolist()
             })
 
     og_regions = []
 
-    """
-    for k, r in list(R.items()):
-        if k in R_pop_list:
-            og_regions.append({
-                'rect': (
-                    r['og_min_x'], r['og_min_y'],
-                    r['og_max_x'] - r['og_min_x'], r['og_max_y'] - r['og_min_y']),
-                'size': r['size'],
-                'labels': r['labels']
-            })
-    """
-
     return img, regions, og_regions
 
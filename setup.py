@@ -16,5 +16,6 @@ setup(
     ],
     keywords='rcnn',
     packages=find_packages(),
-    install_requires=['numpy', 'scikit-image'],
+    install_requires=['numpy', 'scipy', 'scikit-image'],
+    extras_require={'cuda': ['numba']},
 )